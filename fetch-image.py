@@ -11,17 +11,29 @@ from __future__ import annotations
 
 import argparse
 import csv
+import itertools
+import queue
+import re
 import sys
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from threading import Thread
 from pathlib import Path
 from typing import Optional, Tuple
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import soupsieve
 from bs4 import BeautifulSoup
 
+try:
+    # C-implemented parser; ~20-50x faster than html.parser on real pages
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
 # Defaults (can be overridden via CLI)
 INPUT_CSV = "sample.csv"
 INPUT_CSV = "sample.csv"
@@ -29,6 +41,23 @@ PAGEURL_COLUMN_NAME = "PageUrl"   # case-insensitive match
 IMAGE_COLUMN_NAME = "ImageURL"
 
 DEFAULT_IMAGE_SELECTOR = "div.ms-rtestate-field img"
+
+# Fast path for the default selector only: find the ms-rtestate-field
+# container and the first <img> inside it with a few C regex scans,
+# skipping the full HTML parse. Any miss falls through to the parser.
+# The container must be an actual <div> whose class attribute carries
+# ms-rtestate-field as a whole token, mirroring 'div.ms-rtestate-field';
+# the bare string also shows up in scripts and unrelated attributes.
+FAST_CONTAINER_RE = re.compile(
+    r'<div\b[^>]*(?<![-\w])class\s*=\s*["\'][^"\']*'
+    r'(?<![-\w])ms-rtestate-field(?![-\w])[^"\']*["\'][^>]*>',
+    re.IGNORECASE)
+FAST_IMG_TAG_RE = re.compile(r'<img\b[^>]*>', re.IGNORECASE)
+# (?<![-\w]) keeps the src pattern from matching inside data-src
+FAST_SRC_RE = re.compile(r'(?<![-\w])src\s*=\s*["\']([^"\']+)', re.IGNORECASE)
+FAST_DATA_SRC_RE = re.compile(r'(?<![-\w])data-src\s*=\s*["\']([^"\']+)', re.IGNORECASE)
+
+CSV_BATCH_SIZE = 1024
 NUM_WORKERS = 8
 REQUEST_TIMEOUT = 12
 RETRY_COUNT = 2
@@ -42,16 +71,53 @@ VERBOSE = False
 VERIFY_BUNDLE: Optional[str] = None
 INSECURE = False
 ERROR_LOG_FILE = "fetch_errors.log"
-LOG_LOCK = Lock()
+
+# Workers push error lines here; a single writer thread drains the queue
+# in batches so no worker ever blocks on file I/O or a lock.
+LOG_Q: queue.SimpleQueue = queue.SimpleQueue()
+_LOG_SENTINEL = object()
+
+# Shared session so TCP/TLS connections are reused across rows.
+# Adapters (pool size, retries) are mounted in main() once workers are known.
+SESSION = requests.Session()
 
 def log_missing(msg: str) -> None:
     """Log missing images or failed URLs to a separate file safely."""
-    with LOG_LOCK:
-        try:
-            with open(ERROR_LOG_FILE, "a", encoding="utf-8") as f:
-                f.write(msg + "\n")
-        except Exception as e:
-            print(f"[ERROR] Could not write to error log: {e}", file=sys.stderr)
+    LOG_Q.put_nowait(msg)
+
+def drain_error_log() -> None:
+    """Writer-thread loop: batch queued messages into single writes.
+
+    The log file is only created once the first message arrives, matching
+    the old behaviour of clean runs leaving no log behind.
+    """
+    f = None
+    done = False
+    try:
+        while not done:
+            msg = LOG_Q.get()
+            if msg is _LOG_SENTINEL:
+                break
+            batch = [msg]
+            while True:
+                try:
+                    nxt = LOG_Q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _LOG_SENTINEL:
+                    done = True
+                    break
+                batch.append(nxt)
+            try:
+                if f is None:
+                    f = open(ERROR_LOG_FILE, "a", encoding="utf-8")
+                f.write("\n".join(batch) + "\n")
+                f.flush()
+            except Exception as e:
+                print(f"[ERROR] Could not write to error log: {e}", file=sys.stderr)
+    finally:
+        if f is not None:
+            f.close()
 
 def log(msg: str = "", /) -> None:
     """Log only when VERBOSE is enabled."""
@@ -59,48 +125,90 @@ def log(msg: str = "", /) -> None:
         print(msg)
 
 def fetch_html(url: str) -> Tuple[Optional[str], Optional[str]]:
-    """Fetch HTML for a URL with retry/backoff. Returns (html, final_url) or (None, None)."""
+    """Fetch HTML for a URL. Retries/backoff are handled by the session's
+    mounted Retry adapter. Returns (html, final_url) or (None, None)."""
     log(f"[DEBUG] Fetching URL: {url}")
-    last_exc = None
-    for attempt in range(RETRY_COUNT + 1):
+    try:
+        # choose verify parameter
+        verify_arg = False if INSECURE else (VERIFY_BUNDLE if VERIFY_BUNDLE else True)
         try:
-            # choose verify parameter
-            verify_arg = False if INSECURE else (VERIFY_BUNDLE if VERIFY_BUNDLE else True)
-            try:
-                r = requests.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT, verify=verify_arg)
-            except requests.exceptions.SSLError:
-                # Fallback to insecure if verification failed
-                if not INSECURE:
-                    log(f"[WARN] SSL Verify failed for {url}. Retrying with verify=False.")
-                    # suppress warnings for cleaner output
-                    import urllib3
-                    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-                    r = requests.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT, verify=False)
-                else:
-                    raise
-
-            log(f"[DEBUG] Attempt {attempt + 1} Status: {r.status_code}")
-            r.raise_for_status()
-            return r.text, r.url
-        except Exception as e:
-            last_exc = e
-            log(f"[ERROR] Fetch failed (attempt {attempt + 1}): {e}")
-            # backoff
-            time.sleep(1 + attempt)
-    log(f"[ERROR] All fetch attempts failed for: {url}  (last error: {last_exc})")
-    return None, None
-
-def extract_image_from_html(html: str, base_url: str, selector: str) -> Optional[str]:
-    """Return resolved image URL found using the provided CSS selector."""
-    log(f"[DEBUG] Parsing HTML from: {base_url} with selector: '{selector}'")
-    soup = BeautifulSoup(html, "html.parser")
-
-    img_tag = soup.select_one(selector)
-    if not img_tag:
-        log(f"[WARN] No element found matching selector: '{selector}'")
+            r = SESSION.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT, verify=verify_arg)
+        except requests.exceptions.SSLError:
+            # Fallback to insecure if verification failed
+            if not INSECURE:
+                log(f"[WARN] SSL Verify failed for {url}. Retrying with verify=False.")
+                # suppress warnings for cleaner output
+                import urllib3
+                urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+                r = SESSION.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT, verify=False)
+            else:
+                raise
+
+        log(f"[DEBUG] Status: {r.status_code}")
+        r.raise_for_status()
+        return r.text, r.url
+    except Exception as e:
+        log(f"[ERROR] Fetch failed for: {url}  (error: {e})")
+        return None, None
+
+def compile_selector(selector: str):
+    """Pre-compile the CSS selector once instead of per page.
+
+    With selectolax the lexbor engine takes the raw string; for the
+    BeautifulSoup fallback this returns a compiled soupsieve matcher.
+    """
+    if LexborHTMLParser is not None:
+        return selector
+    return soupsieve.compile(selector)
+
+def fast_path_src(html: str) -> Optional[str]:
+    """Best-effort scan for the default selector: src of the first <img>
+    inside the first ms-rtestate-field container.
+
+    Returns None on anything ambiguous so the caller falls through to the
+    full parser. The scan is bounded by the container's next closing div,
+    so an <img> later in the document can never be picked up.
+    """
+    container = FAST_CONTAINER_RE.search(html)
+    if not container:
         return None
-
-    src = img_tag.get("src") or img_tag.get("data-src") or ""
+    end = html.find("</div", container.end())
+    if end == -1:
+        return None
+    tag = FAST_IMG_TAG_RE.search(html, container.end(), end)
+    if not tag:
+        return None
+    attrs = tag.group(0)
+    # Same preference order as the parser paths: src, then data-src
+    m = FAST_SRC_RE.search(attrs) or FAST_DATA_SRC_RE.search(attrs)
+    return m.group(1) if m else None
+
+def extract_image_from_html(html: str, base_url: str, compiled_sel, use_fast_path: bool = False) -> Optional[str]:
+    """Return resolved image URL found using the pre-compiled CSS selector."""
+    log(f"[DEBUG] Parsing HTML from: {base_url} with selector: '{getattr(compiled_sel, 'pattern', compiled_sel)}'")
+    src = None
+
+    if use_fast_path:
+        src = fast_path_src(html)
+        if src is not None:
+            log("[DEBUG] Fast-path regex hit")
+
+    if src is None and LexborHTMLParser is not None:
+        tree = LexborHTMLParser(html)
+        node = tree.css_first(compiled_sel)
+        if node is None:
+            log("[WARN] No element found matching selector")
+            return None
+        src = node.attributes.get("src") or node.attributes.get("data-src") or ""
+    elif src is None:
+        soup = BeautifulSoup(html, "html.parser")
+
+        img_tag = compiled_sel.select_one(soup)
+        if not img_tag:
+            log("[WARN] No element found matching selector")
+            return None
+
+        src = img_tag.get("src") or img_tag.get("data-src") or ""
     log(f"[DEBUG] Raw image src: {repr(src)}")
     src = src.strip()
     if not src:
@@ -127,7 +235,7 @@ def find_pagecol(fieldnames: list[str]) -> Optional[str]:
             return c
     return None
 
-def process_row(page_url: str, selector: str) -> str:
+def process_row(page_url: str, compiled_sel, use_fast_path: bool = False) -> str:
     """Process a single page URL and return the resolved image URL or empty string."""
     log(f"\n=== Processing PageUrl: {page_url} ===")
     if not page_url:
@@ -138,7 +246,7 @@ def process_row(page_url: str, selector: str) -> str:
         log("[ERROR] No HTML returned for page")
         log_missing(f"URL_FAIL: {page_url}")
         return ""
-    img = extract_image_from_html(html, final_url or page_url, selector)
+    img = extract_image_from_html(html, final_url or page_url, compiled_sel, use_fast_path)
     log(f"[DEBUG] Final extracted image URL: {img}")
     
     if not img:
@@ -181,78 +289,21 @@ def main() -> None:
                 print("[WARN] 'certifi' not available. Install with: pip install certifi")
                 print("You can also pass --ca-bundle /path/to/ca-bundle.pem or use --insecure to skip verification.")
                 # continue — requests will use system defaults (which on mac sometimes fail)
+    # Mount pooled adapters sized to the worker count, with retry/backoff
+    # replacing the old manual retry loop in fetch_html.
+    retries = Retry(total=RETRY_COUNT, backoff_factor=0.5,
+                    status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=args.workers,
+                          pool_maxsize=args.workers * 4,
+                          max_retries=retries)
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+
     input_path = Path(args.input)
     if not input_path.exists():
         print(f"[ERROR] Input file not found: {input_path}", file=sys.stderr)
         sys.exit(1)
 
-    # Read CSV and detect PageUrl column case-insensitively
-    with open(input_path, newline="", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        fieldnames = reader.fieldnames or []
-        if not fieldnames:
-            print("[ERROR] Input CSV has no header.", file=sys.stderr)
-            sys.exit(1)
-        page_col = find_pagecol(fieldnames)
-        if not page_col:
-            print(f"[ERROR] Could not find a PageUrl-like column in {args.input}.", file=sys.stderr)
-            print("Existing columns:", fieldnames, file=sys.stderr)
-            sys.exit(1)
-        rows = [r for r in reader]
-
-    total_rows_available = len(rows)
-    limit = args.limit
-    if limit < 0:
-        limit = 0
-    if limit == 0:
-        to_process = rows[:]  # all
-    else:
-        to_process = rows[:min(limit, total_rows_available)]
-
-    if not to_process:
-        print("[INFO] No rows to process (limit resulted in 0 rows). Exiting.")
-        sys.exit(0)
-
-    print(f"[INFO] Processing {len(to_process)} row(s) (of {total_rows_available} available). Insecure={INSECURE}")
-
-    # Process concurrently and collect image URLs
-    results: list[str] = ["" for _ in range(len(to_process))]
-    completed_count = 0
-    with ThreadPoolExecutor(max_workers=args.workers) as ex:
-        future_to_index = {}
-        for idx, row in enumerate(to_process):
-            url = (row.get(page_col) or "").strip()
-            future = ex.submit(process_row, url, args.selector)
-            future_to_index[future] = (idx, url)
-
-        for fut in as_completed(future_to_index):
-            idx, url = future_to_index[fut]
-            try:
-                imgurl = fut.result()
-            except Exception as e:
-                imgurl = ""
-                log(f"[ERROR] Exception while processing {url}: {e}")
-            results[idx] = imgurl
-            completed_count += 1
-            found_text = "yes" if imgurl else "no"
-            print(f"[PROG] Completed [{completed_count}/{len(to_process)}] idx={idx+1} -> image found: {found_text} (PageUrl: {url})")
-
-    # Attach image URLs to corresponding rows (only for the processed subset)
-    for i, img in enumerate(results):
-        to_process[i][IMAGE_COLUMN_NAME] = img
-
-    # Filter: only rows with a non-empty ImageURL
-    rows_with_images = [r for r in to_process if r.get(IMAGE_COLUMN_NAME)]
-
-    if not rows_with_images:
-        print("[INFO] No images were found for the processed rows. No output file will be written.")
-        sys.exit(0)
-
-    # Prepare output headers (preserve original headers, add ImageURL if missing)
-    out_fieldnames = list(fieldnames)
-    if IMAGE_COLUMN_NAME not in out_fieldnames:
-        out_fieldnames.append(IMAGE_COLUMN_NAME)
-
     if args.output:
         output_path = Path(args.output)
     else:
@@ -262,16 +313,127 @@ def main() -> None:
         suffix = input_path.suffix
         output_path = input_path.with_name(f"{stem}_with_images{suffix}")
 
-    output_path = Path(output_path)
-    with open(output_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=out_fieldnames)
-        writer.writeheader()
-        for row in rows_with_images:
-            if IMAGE_COLUMN_NAME not in row:
-                row[IMAGE_COLUMN_NAME] = ""
-            writer.writerow(row)
+    limit = args.limit
+    if limit < 0:
+        limit = 0
+
+    # Read CSV lazily in batches of CSV_BATCH_SIZE rows and detect the
+    # PageUrl column case-insensitively; memory stays bounded no matter
+    # how large the export is.
+    written = 0
+    completed_count = 0
+    out_file = None
+    writer = None
+    log_thread = Thread(target=drain_error_log, daemon=True)
+    log_thread.start()
+    try:
+        with open(input_path, newline="", encoding="utf-8") as f:
+            # Plain csv.reader + fixed indexes: the column positions are
+            # invariant, so there's no need to build a dict per row.
+            reader = csv.reader(f)
+            fieldnames = next(reader, None) or []
+            if not fieldnames:
+                print("[ERROR] Input CSV has no header.", file=sys.stderr)
+                sys.exit(1)
+            page_col = find_pagecol(fieldnames)
+            if not page_col:
+                print(f"[ERROR] Could not find a PageUrl-like column in {args.input}.", file=sys.stderr)
+                print("Existing columns:", fieldnames, file=sys.stderr)
+                sys.exit(1)
+            page_idx = fieldnames.index(page_col)
+
+            # Prepare output headers (preserve original headers, add ImageURL if missing)
+            out_fieldnames = list(fieldnames)
+            if IMAGE_COLUMN_NAME in out_fieldnames:
+                img_idx = out_fieldnames.index(IMAGE_COLUMN_NAME)
+            else:
+                img_idx = len(out_fieldnames)
+                out_fieldnames.append(IMAGE_COLUMN_NAME)
+
+            row_iter = reader if limit == 0 else itertools.islice(reader, limit)
+
+            # Compile the selector once for the whole run; the regex fast
+            # path only applies to the default SharePoint selector
+            compiled_sel = compile_selector(args.selector)
+            use_fast_path = args.selector == DEFAULT_IMAGE_SELECTOR
+
+            print(f"[INFO] Processing rows in batches of {CSV_BATCH_SIZE}. Insecure={INSECURE}")
+
+            with ThreadPoolExecutor(max_workers=args.workers) as ex:
+                while True:
+                    batch = list(itertools.islice(row_iter, CSV_BATCH_SIZE))
+                    if not batch:
+                        break
+
+                    # Process the batch concurrently with a sliding window:
+                    # only workers*4 futures are in flight (and tracked) at
+                    # once instead of one future per batch row.
+                    results: list[str] = ["" for _ in range(len(batch))]
+                    max_in_flight = args.workers * 4
+                    in_flight = {}
+                    idx_iter = iter(enumerate(batch))
+                    exhausted = False
+
+                    while True:
+                        while not exhausted and len(in_flight) < max_in_flight:
+                            try:
+                                idx, row = next(idx_iter)
+                            except StopIteration:
+                                exhausted = True
+                                break
+                            url = row[page_idx].strip() if len(row) > page_idx else ""
+                            future = ex.submit(process_row, url, compiled_sel, use_fast_path)
+                            in_flight[future] = (idx, url)
+
+                        if not in_flight:
+                            break
+
+                        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            idx, url = in_flight.pop(fut)
+                            try:
+                                imgurl = fut.result()
+                            except Exception as e:
+                                imgurl = ""
+                                log(f"[ERROR] Exception while processing {url}: {e}")
+                            results[idx] = imgurl
+                            completed_count += 1
+                            found_text = "yes" if imgurl else "no"
+                            print(f"[PROG] Completed [{completed_count}] -> image found: {found_text} (PageUrl: {url})")
+
+                    # Write this batch's hits before reading the next batch.
+                    # Only rows with a non-empty ImageURL are kept; the output
+                    # file is created lazily so an empty run writes nothing.
+                    for row, img in zip(batch, results):
+                        if not img:
+                            continue
+                        # Pad ragged rows to the output width, then slot the
+                        # image URL in at its fixed index
+                        if len(row) < len(out_fieldnames):
+                            row = row + [""] * (len(out_fieldnames) - len(row))
+                        row[img_idx] = img
+                        if writer is None:
+                            out_file = open(output_path, "w", newline="", encoding="utf-8")
+                            writer = csv.writer(out_file)
+                            writer.writerow(out_fieldnames)
+                        writer.writerow(row)
+                        written += 1
+    finally:
+        # Flush any queued error lines before leaving
+        LOG_Q.put(_LOG_SENTINEL)
+        log_thread.join()
+        if out_file is not None:
+            out_file.close()
+
+    if completed_count == 0:
+        print("[INFO] No rows to process (limit resulted in 0 rows). Exiting.")
+        sys.exit(0)
+
+    if written == 0:
+        print("[INFO] No images were found for the processed rows. No output file was written.")
+        sys.exit(0)
 
-    print(f"[INFO] Wrote {len(rows_with_images)} row(s) with images to: {output_path}")
+    print(f"[INFO] Wrote {written} row(s) with images to: {output_path}")
 
 if __name__ == "__main__":
     main()